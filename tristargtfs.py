@@ -1,14 +1,18 @@
 import argparse
 import csv
 import io
+import json
 import os
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import date, datetime, timedelta
-from itertools import chain
+from datetime import date, datetime
+from itertools import groupby
+from operator import itemgetter
 from tempfile import TemporaryFile
-from typing import Dict, Generator, List, NamedTuple, Set, Tuple
+from typing import (IO, Callable, Dict, Generator, Iterator, List, NamedTuple, Optional, Sequence,
+                    Set, Tuple)
 
 import requests
 
@@ -19,74 +23,203 @@ __email__ = "".join(chr(i) for i in [109, 107, 117, 114, 97, 110, 111, 119, 115,
                                      1072, 116, 93, 32, 103, 109, 97, 105, 108, 46, 99, 111, 109])
 
 
-NORMALIZE_ROUTE_TYPES: Dict[str, str] = {"700": "3", "800": "11", "900": "0"}
+NORMALIZE_ROUTE_TYPES: Dict[str, str] = {"700": "3", "800": "11", "900": "0", "1200": "4"}
 
+# Colors from mzkzg.org map, by (agency_id, normalized route_type)
+ROUTE_COLORS: Dict[Tuple[str, str], Tuple[str, str]] = {
+    ("1", "0"): ("D4151D", "FFFFFF"),  # ZTM Gdańsk Tram
+    ("1", "4"): ("6CF1FA", "000000"),  # ZTM Gdańsk Ferry
+    ("2", "11"): ("91BE40", "000000"),  # ZKM Gdynia Trolleybus
+}
 
-class ServiceDate(NamedTuple):
-    service_id: str
-    date: date
+ZTM_BUS_COLORS: Tuple[str, str] = ("FC7DAB", "000000")
+ZKM_BUS_COLORS: Tuple[str, str] = ("009CDA", "FFFFFF")
 
+STOPS_HEADER: List[str] = ["stop_id", "stop_name", "stop_lat", "stop_lon"]
 
-def gdansk_route_names() -> Dict[str, str]:
+ROUTES_HEADER: List[str] = [
+    "agency_id", "route_id", "route_short_name", "route_long_name",
+    "route_type", "route_color", "route_text_color",
+]
+
+TRIPS_HEADER: List[str] = [
+    "route_id", "service_id", "trip_id", "trip_headsign",
+    "direction_id", "shape_id", "wheelchair_accessible",
+]
+
+STOP_TIMES_HEADER: List[str] = [
+    "trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence",
+    "pickup_type", "drop_off_type",
+]
+
+SHAPES_HEADER: List[str] = ["shape_id", "shape_pt_sequence", "shape_pt_lat", "shape_pt_lon"]
+
+# Buffer size for the merged GTFS tables - stop_times.txt alone has millions of rows
+OUTPUT_BUFFERING = 1 << 20
+
+
+class CsvTable(NamedTuple):
+    """A csv file read as plain lists, with column positions taken from its header"""
+    columns: Dict[str, int]
+    rows: Iterator[List[str]]
+
+    def picker(self, fields: List[str]) -> Callable[[List[str]], Sequence[str]]:
+        """Returns a function extracting given fields (in that order) from a row.
+        Fields missing from the file are returned as empty strings."""
+        indices = [self.columns.get(field, -1) for field in fields]
+
+        if -1 in indices:
+            return lambda row: [row[i] if i >= 0 else "" for i in indices]
+        else:
+            return itemgetter(*indices)
+
+
+def parse_gtfs_date(value: str) -> date:
+    """Parses a GTFS date (YYYYMMDD), much faster than datetime.strptime"""
+    return date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+
+def ids_with_prefix(ids: Set[str], prefix: str) -> Set[str]:
+    """Returns ids starting with prefix, with the prefix removed"""
+    return {i[len(prefix):] for i in ids if i.startswith(prefix)}
+
+
+def save_response(req: requests.Response, target: IO[bytes]) -> None:
+    """Writes the body of a streamed response into target, without holding it all in memory"""
+    for chunk in req.iter_content(chunk_size=1 << 20):
+        target.write(chunk)
+
+
+def update_cached_file(session: requests.Session, url: str, path: str) -> None:
+    """Ensures the file at path has the current content of url.
+    Validators of the cached response (ETag and Last-Modified) are stored in path + ".json",
+    so that the file is only re-downloaded if the server reports a change."""
+    validators_path = path + ".json"
+    headers: Dict[str, str] = {}
+
+    if os.path.exists(path) and os.path.exists(validators_path):
+        with open(validators_path, mode="r", encoding="utf-8") as f:
+            headers = json.load(f)
+
+    with session.get(url, headers=headers, stream=True) as req:
+        req.raise_for_status()
+
+        if req.status_code == 304:
+            return
+
+        # Replace the file atomically, so that an interrupted download
+        # can't be mistaken for a valid cached copy
+        with open(path + ".part", mode="wb") as f:
+            save_response(req, f)
+        os.replace(path + ".part", path)
+
+    headers = {}
+    if "ETag" in req.headers:
+        headers["If-None-Match"] = req.headers["ETag"]
+    if "Last-Modified" in req.headers:
+        headers["If-Modified-Since"] = req.headers["Last-Modified"]
+
+    with open(validators_path, mode="w", encoding="utf-8") as f:
+        json.dump(headers, f)
+
+
+def download_zip(session: requests.Session, url: str,
+                 cache_file: Optional[str] = None) -> zipfile.ZipFile:
+    """Downloads a ZIP archive from url and opens it for reading.
+    If cache_file is given, the archive is kept there between runs (see update_cached_file)."""
+    if cache_file:
+        update_cached_file(session, url, cache_file)
+        return zipfile.ZipFile(cache_file, mode="r")
+
+    target = TemporaryFile()
+
+    with session.get(url, stream=True) as req:
+        req.raise_for_status()
+        save_response(req, target)
+
+    target.seek(0)
+    return zipfile.ZipFile(target, mode="r")
+
+
+def gdansk_route_names(session: requests.Session,
+                       cache_file: Optional[str] = None) -> Dict[str, str]:
     """Returns a mapping from route_short_name to route_long_name for ZTM Gdańsk,
-    as route_long_names aren't included in the main GTFS."""
-    req = requests.get("https://ckan.multimediagdansk.pl/dataset/c24aa637-3619-4dc2-a171-a23eec8f2172/resource/22313c56-5acf-41c7-a5fd-dc5dc72b3851/download/routes.json")  # noqa
-    req.raise_for_status()
-    all_routes = req.json()
+    as route_long_names aren't included in the main GTFS.
+    If cache_file is given, the source JSON is kept there between runs (see update_cached_file)."""
+    url = "https://ckan.multimediagdansk.pl/dataset/c24aa637-3619-4dc2-a171-a23eec8f2172/resource/22313c56-5acf-41c7-a5fd-dc5dc72b3851/download/routes.json"  # noqa
+
+    if cache_file:
+        update_cached_file(session, url, cache_file)
+        with open(cache_file, mode="r", encoding="utf-8") as f:
+            all_routes = json.load(f)
+
+    else:
+        req = session.get(url)
+        req.raise_for_status()
+        all_routes = req.json()
 
     route_names: Dict[str, str] = {
         "F5": "Żabi Kruk - Westerplatte - Brzeźno",
         "F6": "Targ Rybny - Sobieszewo"}
 
-    for routes in map(lambda i: all_routes[i]["routes"], sorted(all_routes.keys())):
-        for route in routes:
-            if route["routeShortName"] in route_names:
-                continue
-            else:
-                route_names[route["routeShortName"]] = route["routeLongName"].strip()
+    # Names from the earliest day take precedence
+    for day in sorted(all_routes):
+        for route in all_routes[day]["routes"]:
+            route_names.setdefault(route["routeShortName"], route["routeLongName"].strip())
 
     return route_names
 
 
 def route_color(agency: str, traction: str) -> Tuple[str, str]:
     """Generate route_color and route_text_color given an agency and route_type"""
-    # Colors from mzkzg.org map
-
-    # ZTM Gdańsk
-    if agency == "1":
-        if traction in {"0", "900"}:
-            return "D4151D", "FFFFFF"  # Tram
-        elif traction == {"4", "1200"}:
-            return "6CF1FA", "000000"  # Ferry
-        else:
-            return "FC7DAB", "000000"  # Bus
+    default = ZTM_BUS_COLORS if agency == "1" else ZKM_BUS_COLORS
+    return ROUTE_COLORS.get((agency, traction), default)
 
-    # ZKM Gdańsk
-    else:
-        if traction in {"11", "800"}:
-            return "91BE40", "000000"  # Trolleybus
-        else:
-            return "009CDA", "FFFFFF"  # Bus
+
+def data_rows(reader: Iterator[List[str]], width: int) -> Iterator[List[str]]:
+    """Skips blank lines and pads rows shorter than the header with empty strings,
+    the same way csv.DictReader treats them."""
+    for row in reader:
+        if not row:
+            continue
+        elif len(row) < width:
+            row.extend([""] * (width - len(row)))
+        yield row
 
 
 @contextmanager
-def csv_reader_from_zip(zip: zipfile.ZipFile, name: str) -> Generator[csv.DictReader, None, None]:
-    with zip.open(name, mode="r") as raw, \
+def csv_table_from_zip(arch: zipfile.ZipFile, name: str) -> Generator[CsvTable, None, None]:
+    with arch.open(name, mode="r") as raw, \
             io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as wrapped:
-        yield csv.DictReader(wrapped)
+        reader = csv.reader(wrapped)
+        header = next(reader)
+        yield CsvTable({column: idx for idx, column in enumerate(header)},
+                       data_rows(reader, len(header)))
+
+
+def open_in_zip(arch: zipfile.ZipFile, name: str) -> IO[str]:
+    """Opens a new text member of the archive for writing.
+    Closing the returned file finishes the member."""
+    raw = arch.open(name, mode="w")
+    buffered = io.BufferedWriter(raw, buffer_size=OUTPUT_BUFFERING)  # type: ignore
+    return io.TextIOWrapper(buffered, encoding="utf-8", newline="")
 
 
 class TristarGtfs:
-    def __init__(self, publisher_name: str = "", publisher_url: str = ""):
+    def __init__(self, publisher_name: str = "", publisher_url: str = "",
+                 cache_dir: Optional[str] = None):
         self.publisher_name: str = publisher_name
         self.publisher_url: str = publisher_url
+        self.cache_dir: Optional[str] = cache_dir
         self.data_download: datetime
 
+        # Both the Gdańsk GTFS and route names are served from the same host,
+        # share one session to reuse the connection
+        self.session = requests.Session()
+
         self.gdansk: zipfile.ZipFile
         self.gdynia: zipfile.ZipFile
-
-        self.gdansk_file = TemporaryFile()
-        self.gdynia_file = TemporaryFile()
+        self.route_names: Dict[str, str]
 
         # self.stop_merge_table = {}
 
@@ -97,339 +230,352 @@ class TristarGtfs:
         self.download()
 
     def download(self) -> None:
-        print("\033[1A\033[K" + "Downloading Gdansk GTFS")
+        print("\033[1A\033[K" + "Downloading Gdansk and Gdynia GTFS and route_long_names")
         self.data_download = datetime.today()
 
-        req = requests.get("https://ckan.multimediagdansk.pl/dataset/c24aa637-3619-4dc2-a171-a23eec8f2172/resource/30e783e4-2bec-4a7d-bb22-ee3e3b26ca96/download/gtfsgoogle.zip")  # noqa
-        req.raise_for_status()
-        self.gdansk_file.write(req.content)
-        self.gdansk_file.seek(0)
-        self.gdansk = zipfile.ZipFile(self.gdansk_file, mode="r")
+        gdansk_cache: Optional[str] = None
+        gdynia_cache: Optional[str] = None
+        routes_cache: Optional[str] = None
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            gdansk_cache = os.path.join(self.cache_dir, "gdansk.zip")
+            gdynia_cache = os.path.join(self.cache_dir, "gdynia.zip")
+            routes_cache = os.path.join(self.cache_dir, "routes.json")
+
+        # All downloads are independent - fetch them concurrently
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            gdansk = executor.submit(
+                download_zip, self.session,
+                "https://ckan.multimediagdansk.pl/dataset/c24aa637-3619-4dc2-a171-a23eec8f2172/resource/30e783e4-2bec-4a7d-bb22-ee3e3b26ca96/download/gtfsgoogle.zip",  # noqa
+                gdansk_cache,
+            )
 
-        print("\033[1A\033[K" + "Downloading Gdynia GTFS")
-        req = requests.get("http://api.zdiz.gdynia.pl/pt/gtfs.zip")
-        req.raise_for_status()
-        self.gdynia_file.write(req.content)
-        self.gdynia_file.seek(0)
-        self.gdynia = zipfile.ZipFile(self.gdynia_file, mode="r")
+            gdynia = executor.submit(
+                download_zip, self.session,
+                "http://api.zdiz.gdynia.pl/pt/gtfs.zip",
+                gdynia_cache,
+            )
+
+            route_names = executor.submit(gdansk_route_names, self.session, routes_cache)
+
+            self.gdansk = gdansk.result()
+            self.gdynia = gdynia.result()
+            self.route_names = route_names.result()
 
-    def static_files(self) -> None:
+    def static_files(self, arch: zipfile.ZipFile) -> None:
         print("\033[1A\033[K" + "Creating agency.txt, feed_info.txt and attributions.txt")
         version = self.data_download.strftime("%Y-%m-%d %H:%M:%S")
 
         # Agency
-        f = open("gtfs/agency.txt", mode="w", encoding="utf8", newline="")
-        w = csv.writer(f)
-        w.writerow([
-            "agency_id", "agency_name", "agency_url", "agency_timezone",
-            "agency_lang", "agency_phone", "agency_fare_url"])
-        w.writerow([
-            "1", "ZTM Gdańsk", "https://ztm.gda.pl/", "Europe/Warsaw",
-            "pl", "+48 58 52 44 500", "https://ztm.gda.pl/bilety/ceny-biletow,a,13"])
-        w.writerow([
-            "2", "ZKM Gdynia", "https://zkmgdynia.pl/", "Europe/Warsaw",
-            "pl", "+48 801 174 194",
-            "https://zkmgdynia.pl/bilety-jednorazowe-zkm-w-gdyni-i-metropolitalne-mzkzg"])
-        f.close()
+        with open_in_zip(arch, "agency.txt") as f:
+            w = csv.writer(f)
+            w.writerow([
+                "agency_id", "agency_name", "agency_url", "agency_timezone",
+                "agency_lang", "agency_phone", "agency_fare_url"])
+            w.writerow([
+                "1", "ZTM Gdańsk", "https://ztm.gda.pl/", "Europe/Warsaw",
+                "pl", "+48 58 52 44 500", "https://ztm.gda.pl/bilety/ceny-biletow,a,13"])
+            w.writerow([
+                "2", "ZKM Gdynia", "https://zkmgdynia.pl/", "Europe/Warsaw",
+                "pl", "+48 801 174 194",
+                "https://zkmgdynia.pl/bilety-jednorazowe-zkm-w-gdyni-i-metropolitalne-mzkzg"])
 
         # Feed Info
         if self.publisher_name and self.publisher_url:
-            f = open("gtfs/feed_info.txt", mode="w", encoding="utf8", newline="")
-            w = csv.writer(f)
-            w.writerow(["feed_publisher_name", "feed_publisher_url", "feed_lang", "feed_version"])
-            w.writerow([self.publisher_name, self.publisher_url, "pl", version])
-            f.close()
+            with open_in_zip(arch, "feed_info.txt") as f:
+                w = csv.writer(f)
+                w.writerow(["feed_publisher_name", "feed_publisher_url", "feed_lang",
+                            "feed_version"])
+                w.writerow([self.publisher_name, self.publisher_url, "pl", version])
 
         # Attributions
-        f = open("gtfs/attributions.txt", mode="w", encoding="utf8", newline="")
-        w = csv.writer(f)
-        w.writerow(["attribution_id", "agency_id", "organization_name", "is_producer",
-                    "is_operator", "is_authority", "is_data_source", "attribution_url"])
-        w.writerow([
-            "1", "1",
-            f"Based on data by: Zarząd Transportu Miejskiego w Gdańsku (retrieved {version})",
-            "0", "1", "1", "1", "https://ckan.multimediagdansk.pl/dataset/tristar"])
-        w.writerow([
-            "2", "2",
-            f"Based on data by: Zarząd Dróg i Zieleni w Gdyni (retrieved {version})",
-            "0", "0", "1", "1", "http://otwartedane.gdynia.pl/pl/dataset/informacje-o-rozkladach-jazdy-i-lokalizacji-przystankow"])  # noqa
-        f.close()
-
-    @staticmethod
-    def compress(target="gtfs.zip") -> None:
-        print("\033[1A\033[K" + "Compressing to " + target)
-        with zipfile.ZipFile(target, mode="w", compression=zipfile.ZIP_DEFLATED) as arch:
-            for f in filter(lambda i: i.name.endswith(".txt"), os.scandir("gtfs")):
-                arch.write(f.path, f.name)
-
-    def merge_stops(self) -> None:
-        file = open("gtfs/stops.txt", mode="w", encoding="utf-8", newline="")
-        writer = csv.DictWriter(file, ["stop_id", "stop_name", "stop_lat", "stop_lon"],
-                                extrasaction="ignore")
-        writer.writeheader()
-
-        # Load merge table
-        # The merge table maps to some non-existing stops and generally causes problems
-
-        # print("\033[1A\033[K" + "Loading stop merge table")
-
-        # req = requests.get("https://ckan.multimediagdansk.pl/dataset/c24aa637-3619-4dc2-a171-a23eec8f2172/resource/f8a5bedb-7925-40c9-8d66-dbbc830939b1/download/przystanki_wspolnegda_gdy.csv")  # noqa
-        # req.raise_for_status()
-        # req.encoding = "utf-8"
-
-        # for row in csv.DictReader(io.StringIO(req.text)):
-        #    source, target = None, None
-
-        #    if row["mapped_organization_id"] == "2":
-        #        if int(row["mapped_gmv_short_name"]) < 30000: source = str(30000 + int(row["mapped_gmv_short_name"]))  # noqa
-        #        else: source = row["mapped_gmv_short_name"]
-        #    else:
-        #        source = row["mapped_gmv_short_name"]
-
-        #    if row["main_organization_id"] == "2":
-        #        if int(row["main_gmv_short_name"]) < 30000: target = str(30000 + int(row["main_gmv_short_name"]))  # noqa
-        #        else: target = row["main_gmv_short_name"]
-        #    else:
-        #        target = row["main_gmv_short_name"]
-
-        #    self.stop_merge_table[source] = target
-
-        print("\033[1A\033[K" + "Merging Gdańsk stops")
-
-        with self.gdansk.open("stops.txt") as buffer:
-            reader = csv.DictReader(io.TextIOWrapper(buffer, encoding="utf-8", newline=""))
-            for row in reader:
-                # if row["stop_id"] in self.stop_merge_table: continue
-
-                # Strip Gdynia from stop names — that's how it's printed on maps, see mzkzg.org
-                if row["stop_name"].startswith("Gdynia"):
-                    row["stop_name"] = row["stop_name"][7:]
-
-                writer.writerow(row)
-
-        print("\033[1A\033[K" + "Merging Gdynia stops")
-
-        with self.gdynia.open("stops.txt") as buffer:
-            reader = csv.DictReader(io.TextIOWrapper(buffer, encoding="utf-8", newline=""))
-            for row in reader:
-                # if int(row["stop_id"]) < 30000: source = str(30000 + int(row["stop_id"]))
-                # else: source = row["stop_id"]
-
-                # if row["stop_id"] in self.stop_merge_table: continue
-                writer.writerow(row)
-
-        file.close()
-
-    def do_merge_routes(self, reader: csv.DictReader, writer: csv.DictWriter, agency_id: str,
+        with open_in_zip(arch, "attributions.txt") as f:
+            w = csv.writer(f)
+            w.writerow(["attribution_id", "agency_id", "organization_name", "is_producer",
+                        "is_operator", "is_authority", "is_data_source", "attribution_url"])
+            w.writerow([
+                "1", "1",
+                "Based on data by: Zarząd Transportu Miejskiego w Gdańsku "
+                f"(retrieved {version})",
+                "0", "1", "1", "1", "https://ckan.multimediagdansk.pl/dataset/tristar"])
+            w.writerow([
+                "2", "2",
+                f"Based on data by: Zarząd Dróg i Zieleni w Gdyni (retrieved {version})",
+                "0", "0", "1", "1", "http://otwartedane.gdynia.pl/pl/dataset/informacje-o-rozkladach-jazdy-i-lokalizacji-przystankow"])  # noqa
+
+    def merge_stops(self, arch: zipfile.ZipFile) -> None:
+        with open_in_zip(arch, "stops.txt") as file:
+            writer = csv.writer(file)
+            writer.writerow(STOPS_HEADER)
+
+            # Load merge table
+            # The merge table maps to some non-existing stops and generally causes problems
+
+            # print("\033[1A\033[K" + "Loading stop merge table")
+
+            # req = requests.get("https://ckan.multimediagdansk.pl/dataset/c24aa637-3619-4dc2-a171-a23eec8f2172/resource/f8a5bedb-7925-40c9-8d66-dbbc830939b1/download/przystanki_wspolnegda_gdy.csv")  # noqa
+            # req.raise_for_status()
+            # req.encoding = "utf-8"
+
+            # for row in csv.DictReader(io.StringIO(req.text)):
+            #    source, target = None, None
+
+            #    if row["mapped_organization_id"] == "2":
+            #        if int(row["mapped_gmv_short_name"]) < 30000: source = str(30000 + int(row["mapped_gmv_short_name"]))  # noqa
+            #        else: source = row["mapped_gmv_short_name"]
+            #    else:
+            #        source = row["mapped_gmv_short_name"]
+
+            #    if row["main_organization_id"] == "2":
+            #        if int(row["main_gmv_short_name"]) < 30000: target = str(30000 + int(row["main_gmv_short_name"]))  # noqa
+            #        else: target = row["main_gmv_short_name"]
+            #    else:
+            #        target = row["main_gmv_short_name"]
+
+            #    self.stop_merge_table[source] = target
+
+            print("\033[1A\033[K" + "Merging Gdańsk stops")
+
+            with csv_table_from_zip(self.gdansk, "stops.txt") as table:
+                name_col = table.columns["stop_name"]
+                pick = table.picker(STOPS_HEADER)
+                rows: List[Sequence[str]] = []
+
+                for row in table.rows:
+                    # if row[stop_col] in self.stop_merge_table: continue
+
+                    # Strip Gdynia from stop names — that's how it's printed on maps,
+                    # see mzkzg.org
+                    if row[name_col].startswith("Gdynia"):
+                        row[name_col] = row[name_col][7:]
+
+                    rows.append(pick(row))
+
+                writer.writerows(rows)
+
+            print("\033[1A\033[K" + "Merging Gdynia stops")
+
+            with csv_table_from_zip(self.gdynia, "stops.txt") as table:
+                # if int(row[stop_col]) < 30000: source = str(30000 + int(row[stop_col]))
+                # else: source = row[stop_col]
+
+                # if row[stop_col] in self.stop_merge_table: continue
+                writer.writerows(map(table.picker(STOPS_HEADER), table.rows))
+
+    def do_merge_routes(self, writer: "csv._writer", table: CsvTable, agency_id: str,
                         prefix: str, route_names: Dict[str, str] = {}) -> None:
-        for row in reader:
-            row["agency_id"] = agency_id
-            row["route_id"] = prefix + row["route_id"]
-            row["route_type"] = NORMALIZE_ROUTE_TYPES[row["route_type"]]
-
-            row["route_short_name"] = row["route_short_name"].strip()
-
-            row["route_long_name"] = route_names.get(row["route_short_name"], "") \
-                .replace('""', '"')
-            row["route_color"], row["route_text_color"] = route_color(row["agency_id"],
-                                                                      row["route_type"])
-
-            writer.writerow(row)
-
-    def merge_routes(self) -> None:
-        file = open("gtfs/routes.txt", mode="w", encoding="utf-8", newline="")
-        writer = csv.DictWriter(file, [
-                "agency_id", "route_id", "route_short_name", "route_long_name",
-                "route_type", "route_color", "route_text_color"
-            ], extrasaction="ignore"
-        )
-        writer.writeheader()
-
-        print("\033[1A\033[K" + "Downloading route_long_names")
-
-        route_names = {}
-        route_names.update(gdansk_route_names())
-
-        print("\033[1A\033[K" + "Merging Gdańsk routes")
-        with csv_reader_from_zip(self.gdansk, "routes.txt") as reader:
-            self.do_merge_routes(reader, writer, "1", "1:", route_names)
-
-        print("\033[1A\033[K" + "Merging Gdynia routes")
-        with csv_reader_from_zip(self.gdynia, "routes.txt") as reader:
-            self.do_merge_routes(reader, writer, "2", "2:", route_names)
-
-    def load_dates(self, reader: csv.DictReader, prefix: str) -> List[ServiceDate]:
-        return [
-            ServiceDate(
-                prefix + row["service_id"],
-                datetime.strptime(row["date"], "%Y%m%d").date(),
-            )
-            for row in reader
-            if row["exception_type"] == "1"
-        ]
-
-    def merge_dates(self) -> None:
-        file = open("gtfs/calendar_dates.txt", mode="w", encoding="utf-8", newline="")
-        writer = csv.DictWriter(file, ["date", "service_id", "exception_type"],
-                                extrasaction="ignore")
-        writer.writeheader()
-
-        print("\033[1A\033[K" + "Loading Gdańsk services")
-        with csv_reader_from_zip(self.gdansk, "calendar_dates.txt") as reader:
-            gdansk_dates = self.load_dates(reader, "1:")
-
-        print("\033[1A\033[K" + "Loading Gdynia services")
-        with csv_reader_from_zip(self.gdynia, "calendar_dates.txt") as reader:
-            gdynia_dates = self.load_dates(reader, "2:")
-
-        print("\033[1A\033[K" + "Exporting all services")
-
-        # Find common start & end date for calendars
-        start_date: date = max(
-            min(i.date for i in gdansk_dates),
-            min(i.date for i in gdynia_dates),
-        )
-
-        end_date: date = min(
-            max(i.date for i in gdansk_dates),
-            max(i.date for i in gdynia_dates),
-        )
-
-        # Figure out which service is active on every day between start_date and end_date
-        services_on_date: Dict[date, Set[str]] = {}
-        for service_date in chain(gdansk_dates, gdynia_dates):
-            if service_date.date > end_date or service_date.date < start_date:
+        route_col = table.columns["route_id"]
+        short_name_col = table.columns["route_short_name"]
+        type_col = table.columns["route_type"]
+        rows: List[List[str]] = []
+
+        for row in table.rows:
+            route_type = NORMALIZE_ROUTE_TYPES[row[type_col]]
+            route_short_name = row[short_name_col].strip()
+            route_long_name = route_names.get(route_short_name, "").replace('""', '"')
+
+            rows.append([
+                agency_id, prefix + row[route_col], route_short_name, route_long_name,
+                route_type, *route_color(agency_id, route_type),
+            ])
+
+        writer.writerows(rows)
+
+    def merge_routes(self, arch: zipfile.ZipFile) -> None:
+        with open_in_zip(arch, "routes.txt") as file:
+            writer = csv.writer(file)
+            writer.writerow(ROUTES_HEADER)
+
+            print("\033[1A\033[K" + "Merging Gdańsk routes")
+            with csv_table_from_zip(self.gdansk, "routes.txt") as table:
+                self.do_merge_routes(writer, table, "1", "1:", self.route_names)
+
+            print("\033[1A\033[K" + "Merging Gdynia routes")
+            with csv_table_from_zip(self.gdynia, "routes.txt") as table:
+                self.do_merge_routes(writer, table, "2", "2:", self.route_names)
+
+    def load_dates(self, table: CsvTable, prefix: str,
+                   service_dates: Set[Tuple[date, str]]) -> Tuple[date, date]:
+        """Adds (day, service_id) pairs of active services to service_dates.
+        Returns the first and the last day with any active service."""
+        service_col = table.columns["service_id"]
+        date_col = table.columns["date"]
+        exception_col = table.columns["exception_type"]
+
+        first_date = date.max
+        last_date = date.min
+
+        for row in table.rows:
+            if row[exception_col] != "1":
                 continue
 
-            services_on_date.setdefault(service_date.date, set()) \
-                            .add(service_date.service_id)
+            day = parse_gtfs_date(row[date_col])
+            service_dates.add((day, prefix + row[service_col]))
 
-        # Save merged services
-        while start_date <= end_date:
-            date_str = start_date.strftime("%Y%m%d")
+            if day < first_date:
+                first_date = day
+            if day > last_date:
+                last_date = day
 
-            for service in sorted(services_on_date[start_date]):
-                writer.writerow(
-                    {"date": date_str, "service_id": service, "exception_type": "1"}
-                )
-                self.active_services.add(service)
+        return first_date, last_date
 
-            start_date += timedelta(days=1)
+    def merge_dates(self, arch: zipfile.ZipFile) -> None:
+        with open_in_zip(arch, "calendar_dates.txt") as file:
+            writer = csv.writer(file)
+            writer.writerow(["date", "service_id", "exception_type"])
 
-        file.close()
+            # Figure out which service is active on every day
+            service_dates: Set[Tuple[date, str]] = set()
 
-    def do_merge_times(self, writer: csv.DictWriter, reader: csv.DictReader, prefix: str) -> None:
-        for row in reader:
-            row["trip_id"] = prefix + row["trip_id"]
-            # row["stop_id"] = self.stop_merge_table.get(row["stop_id"], row["stop_id"])
+            print("\033[1A\033[K" + "Loading Gdańsk services")
+            with csv_table_from_zip(self.gdansk, "calendar_dates.txt") as table:
+                gdansk_start, gdansk_end = self.load_dates(table, "1:", service_dates)
 
-            if row["trip_id"] not in self.active_trips:
-                continue
+            print("\033[1A\033[K" + "Loading Gdynia services")
+            with csv_table_from_zip(self.gdynia, "calendar_dates.txt") as table:
+                gdynia_start, gdynia_end = self.load_dates(table, "2:", service_dates)
+
+            print("\033[1A\033[K" + "Exporting all services")
+
+            # Find common start & end date for calendars
+            start_date: date = max(gdansk_start, gdynia_start)
+            end_date: date = min(gdansk_end, gdynia_end)
+
+            # Save merged services - sorted once, then grouped by day
+            in_range = sorted(i for i in service_dates if start_date <= i[0] <= end_date)
+
+            for day, group in groupby(in_range, key=itemgetter(0)):
+                date_str = day.strftime("%Y%m%d")
 
-            writer.writerow(row)
-
-    def merge_times(self) -> None:
-        file = open("gtfs/stop_times.txt", mode="w", encoding="utf-8", newline="")
-        writer = csv.DictWriter(
-            file,
-            [
-                "trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence",
-                "pickup_type", "drop_off_type",
-            ],
-            extrasaction="ignore",
-        )
-        writer.writeheader()
-
-        print("\033[1A\033[K" + "Merging Gdańsk stop_times")
-        with csv_reader_from_zip(self.gdansk, "stop_times.txt") as reader:
-            self.do_merge_times(writer, reader, "1:")
-
-        print("\033[1A\033[K" + "Merging Gdynia stop_times")
-        with csv_reader_from_zip(self.gdynia, "stop_times.txt") as reader:
-            self.do_merge_times(writer, reader, "2:")
-
-        file.close()
-
-    def do_merge_shapes(self, writer: csv.DictWriter, reader: csv.DictReader, prefix: str) -> None:
-        for row in reader:
-            row["shape_id"] = prefix + row["shape_id"]
-            if row["shape_id"] not in self.active_shapes:
+                services = [service for _, service in group]
+
+                writer.writerows([date_str, service, "1"] for service in services)
+                self.active_services.update(services)
+
+    def do_merge_times(self, writer: "csv._writer", table: CsvTable, prefix: str) -> None:
+        trip_col = table.columns["trip_id"]
+        pick = table.picker(STOP_TIMES_HEADER)
+        active_trips = ids_with_prefix(self.active_trips, prefix)
+        writerow = writer.writerow
+
+        for row in table.rows:
+            trip_id = row[trip_col]
+            if trip_id not in active_trips:
                 continue
 
-            writer.writerow(row)
+            row[trip_col] = prefix + trip_id
+            # row[stop_col] = self.stop_merge_table.get(row[stop_col], row[stop_col])
 
-    def merge_shapes(self) -> None:
-        file = open("gtfs/shapes.txt", mode="w", encoding="utf-8", newline="")
-        writer = csv.DictWriter(
-            file,
-            ["shape_id", "shape_pt_sequence", "shape_pt_lat", "shape_pt_lon"],
-            extrasaction="ignore")
-        writer.writeheader()
+            writerow(pick(row))
 
-        print("\033[1A\033[K" + "Merging Gdańsk shapes")
-        with csv_reader_from_zip(self.gdansk, "shapes.txt") as reader:
-            self.do_merge_shapes(writer, reader, "1:")
+    def merge_times(self, arch: zipfile.ZipFile) -> None:
+        with open_in_zip(arch, "stop_times.txt") as file:
+            writer = csv.writer(file)
+            writer.writerow(STOP_TIMES_HEADER)
 
-        print("\033[1A\033[K" + "Merging Gdynia shapes")
-        with csv_reader_from_zip(self.gdynia, "shapes.txt") as reader:
-            self.do_merge_shapes(writer, reader, "2:")
+            print("\033[1A\033[K" + "Merging Gdańsk stop_times")
+            with csv_table_from_zip(self.gdansk, "stop_times.txt") as table:
+                self.do_merge_times(writer, table, "1:")
 
-        file.close()
+            print("\033[1A\033[K" + "Merging Gdynia stop_times")
+            with csv_table_from_zip(self.gdynia, "stop_times.txt") as table:
+                self.do_merge_times(writer, table, "2:")
 
-    def do_merge_trips(self, writer: csv.DictWriter, reader: csv.DictReader, prefix: str) -> None:
-        for row in reader:
-            row["route_id"] = prefix + row["route_id"]
-            row["service_id"] = prefix + row["service_id"]
-            row["trip_id"] = prefix + row["trip_id"]
-            row["shape_id"] = prefix + row["shape_id"]
+    def do_merge_shapes(self, writer: "csv._writer", table: CsvTable, prefix: str) -> None:
+        shape_col = table.columns["shape_id"]
+        pick = table.picker(SHAPES_HEADER)
+        active_shapes = ids_with_prefix(self.active_shapes, prefix)
+        writerow = writer.writerow
+
+        for row in table.rows:
+            shape_id = row[shape_col]
+            if shape_id not in active_shapes:
+                continue
 
-            if row["service_id"] not in self.active_services:
+            row[shape_col] = prefix + shape_id
+            writerow(pick(row))
+
+    def merge_shapes(self, arch: zipfile.ZipFile) -> None:
+        with open_in_zip(arch, "shapes.txt") as file:
+            writer = csv.writer(file)
+            writer.writerow(SHAPES_HEADER)
+
+            print("\033[1A\033[K" + "Merging Gdańsk shapes")
+            with csv_table_from_zip(self.gdansk, "shapes.txt") as table:
+                self.do_merge_shapes(writer, table, "1:")
+
+            print("\033[1A\033[K" + "Merging Gdynia shapes")
+            with csv_table_from_zip(self.gdynia, "shapes.txt") as table:
+                self.do_merge_shapes(writer, table, "2:")
+
+    def do_merge_trips(self, writer: "csv._writer", table: CsvTable, prefix: str) -> None:
+        route_col = table.columns["route_id"]
+        service_col = table.columns["service_id"]
+        trip_col = table.columns["trip_id"]
+        shape_col = table.columns["shape_id"]
+        headsign_col = table.columns["trip_headsign"]
+        pick = table.picker(TRIPS_HEADER)
+        active_services = ids_with_prefix(self.active_services, prefix)
+        add_active_trip = self.active_trips.add
+        add_active_shape = self.active_shapes.add
+        writerow = writer.writerow
+
+        for row in table.rows:
+            if row[service_col] not in active_services:
                 continue
 
-            row["trip_headsign"] = row["trip_headsign"].rstrip(" 0123456789")
+            row[route_col] = prefix + row[route_col]
+            row[service_col] = prefix + row[service_col]
+            row[trip_col] = prefix + row[trip_col]
+            row[shape_col] = prefix + row[shape_col]
 
-            self.active_trips.add(row["trip_id"])
-            self.active_shapes.add(row["shape_id"])
-            writer.writerow(row)
+            row[headsign_col] = row[headsign_col].rstrip(" 0123456789")
 
-    def merge_trips(self) -> None:
-        file = open("gtfs/trips.txt", mode="w", encoding="utf-8", newline="")
-        writer = csv.DictWriter(
-            file,
-            ["route_id", "service_id", "trip_id", "trip_headsign",
-             "direction_id", "shape_id", "wheelchair_accessible"],
-            extrasaction="ignore")
-        writer.writeheader()
+            add_active_trip(row[trip_col])
+            add_active_shape(row[shape_col])
+            writerow(pick(row))
 
-        print("\033[1A\033[K" + "Merging Gdańsk trips")
-        with csv_reader_from_zip(self.gdansk, "trips.txt") as reader:
-            self.do_merge_trips(writer, reader, "1:")
+    def merge_trips(self, arch: zipfile.ZipFile) -> None:
+        with open_in_zip(arch, "trips.txt") as file:
+            writer = csv.writer(file)
+            writer.writerow(TRIPS_HEADER)
 
-        print("\033[1A\033[K" + "Merging Gdynia trips")
-        with csv_reader_from_zip(self.gdynia, "trips.txt") as reader:
-            self.do_merge_trips(writer, reader, "2:")
+            print("\033[1A\033[K" + "Merging Gdańsk trips")
+            with csv_table_from_zip(self.gdansk, "trips.txt") as table:
+                self.do_merge_trips(writer, table, "1:")
 
-        file.close()
+            print("\033[1A\033[K" + "Merging Gdynia trips")
+            with csv_table_from_zip(self.gdynia, "trips.txt") as table:
+                self.do_merge_trips(writer, table, "2:")
 
     @classmethod
-    def create(cls, target="gtfs.zip", publisher_name=None, publisher_url=None):
+    def create(cls, target="gtfs.zip", publisher_name=None, publisher_url=None, cache_dir=None):
         print("Starting TristarGTFS")
 
-        for file in os.scandir("gtfs"):
-            os.remove(file.path)
+        self = cls(publisher_name, publisher_url, cache_dir)
 
-        self = cls(publisher_name, publisher_url)
+        # Merged tables are written into a temporary archive next to the target,
+        # which only replaces the target once it is complete
+        partial = target + ".part"
+        try:
+            with zipfile.ZipFile(partial, mode="w", compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=1) as arch:
+                self.static_files(arch)
 
-        self.static_files()
+                self.merge_routes(arch)
+                self.merge_stops(arch)
+                self.merge_dates(arch)
+                self.merge_trips(arch)
+                self.merge_shapes(arch)
+                self.merge_times(arch)
 
-        self.merge_routes()
-        self.merge_stops()
-        self.merge_dates()
-        self.merge_trips()
-        self.merge_shapes()
-        self.merge_times()
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
 
-        self.compress(target)
+        os.replace(partial, target)
 
 
 if __name__ == "__main__":
@@ -442,6 +588,10 @@ if __name__ == "__main__":
                         dest="publisher_name", help="value of feed_publisher_name")
     argprs.add_argument("-pu", "--publisher-url", required=False, metavar="URL",
                         dest="publisher_url", help="value of feed_publisher_url")
+    argprs.add_argument("-c", "--cache-dir", required=False, metavar="(path)",
+                        dest="cache_dir",
+                        help="directory to keep upstream GTFS files and route names in between "
+                             "runs, re-downloading them only when changed (default: no caching)")
 
     args = argprs.parse_args()
 
@@ -454,6 +604,6 @@ if __name__ == "__main__":
     |_|_|  |_|___/\__\__,_|_|   \_____|  |_|  |_|   |_____/
     """)
 
-    TristarGtfs.create(args.target, args.publisher_name, args.publisher_url)
+    TristarGtfs.create(args.target, args.publisher_name, args.publisher_url, args.cache_dir)
 
     print("=== Done! In %s sec. ===" % round(time.time() - st, 3))
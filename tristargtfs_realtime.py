@@ -1,8 +1,13 @@
 from google.transit import gtfs_realtime_pb2 as gtfs_rt
-from datetime import timedelta, datetime, time
+from datetime import timedelta, datetime, time as time_of_day
 from tempfile import TemporaryFile
+from functools import lru_cache
+from operator import attrgetter
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import email.utils
 import argparse
+import sys
 import requests
 import zipfile
 import time
@@ -16,57 +21,96 @@ __author__ = "Mikołaj Kuranowski"
 __email__ = "mikolaj@mkuran.pl"
 __license__ = "MIT"
 
+StopDelay = namedtuple("StopDelay", ["stop_id", "timestamp", "delay", "estimated"])
+
+HTML_TAG = re.compile(r"<.*?>")
+HTML_REPLACEMENTS = {"<br />": "\n", "<br>": "\n", "<br >": "\n", "<p>": "\n\n"}
+
+# Status lines overwrite the previous one, but only on a terminal - keep logs free of escape codes
+STATUS_PREFIX = "\033[1A\033[K" if sys.stdout.isatty() else ""
+
+def status(text, **kwargs):
+    print(STATUS_PREFIX + text, **kwargs)
+
 def is_url(url):
     if url.startswith("https://") or url.startswith("ftp://") or url.startswith("http://"):
         return True
     else:
         return False
 
+@lru_cache(maxsize=None)
 def readable_time(departure_time):
-    h, m, s = map(int, departure_time.split(":"))
-    h = h % 24
-    return "{:0>2d}:{:0>2d}".format(h, m)
+    # GTFS times are H:MM:SS or HH:MM:SS - only the hour has variable width
+    h = int(departure_time[:-6]) % 24
+    return "{:0>2d}:{}".format(h, departure_time[-5:-3])
+
+def open_zip_text(arch, name):
+    "Open a text file from a ZIP archive, decompressing it in large chunks"
+    buffer = io.BufferedReader(arch.open(name, mode="r"), buffer_size=1 << 20)
+    return io.TextIOWrapper(buffer, encoding="utf8", newline="")
+
+def html_tag_replacement(match):
+    return HTML_REPLACEMENTS.get(match.group(0), "")
 
 def no_html(text):
     "Clean text from html tags"
     if text == None or text == "": return ""
-    text = text.replace("<br />", "\n").replace("<br>", "\n").replace("<br >", "\n")
-    text = text.replace("<p>", "\n\n")
-    text = re.sub("<.*?>", "", text)
-
-    return text
+    # Line breaks and paragraphs become newlines, every other tag is dropped - all in one pass
+    return HTML_TAG.sub(html_tag_replacement, text)
 
 class GdanskData:
-    def __init__(self, source, debug):
+    def __init__(self, source, debug, session=None):
         self.source = source
+        self.session = session or requests.Session()
 
         self.time = datetime.min
+        self.etag = None
+        self.last_modified = None
 
         self.services = set()
 
         self.debug = bool(debug)
 
         self.trips_route = {}
-        self.stop_trips = {}
+        self.stop_trips = {}  # (stop_id, route_id, departure_time) → trip_id
 
         self.gtfs = None
         self.arch = None
 
     def get_gtfs(self):
         if is_url(self.source):
-            print("\033[1A\033[K" + "Requesting GTFS from " + self.source)
-            gtfs_request = requests.get(self.source)
-            self.time = email.utils.parsedate_to_datetime(gtfs_request.headers["Last-Modified"])
-            self.gtfs = TemporaryFile()
-            self.gtfs.write(gtfs_request.content)
-            self.gtfs.seek(0)
+            status("Requesting GTFS from " + self.source)
+
+            # Only download the file if it differs from the one already loaded
+            headers = {}
+            if self.arch is not None:
+                if self.etag: headers["If-None-Match"] = self.etag
+                if self.last_modified: headers["If-Modified-Since"] = self.last_modified
+
+            with self.session.get(self.source, headers=headers, stream=True) as gtfs_request:
+                if gtfs_request.status_code == 304: return
+                gtfs_request.raise_for_status()
+
+                etag = gtfs_request.headers.get("ETag")
+                last_modified = gtfs_request.headers["Last-Modified"]
+                modified = email.utils.parsedate_to_datetime(last_modified)
+
+                gtfs = TemporaryFile()
+                for chunk in gtfs_request.iter_content(chunk_size=1 << 20):
+                    gtfs.write(chunk)
+
+            gtfs.seek(0)
+            arch = zipfile.ZipFile(gtfs, mode="r")
+
+            # Replace the loaded file only once the new one was fully downloaded
+            self.gtfs, self.arch = gtfs, arch
+            self.etag, self.last_modified, self.time = etag, last_modified, modified
 
         else:
-            print("\033[1A\033[K" + "Reading local GTFS from " + self.source)
+            status("Reading local GTFS from " + self.source)
             self.gtfs = open(self.source, mode="rb")
             self.time = datetime.fromtimestamp(os.stat(self.source).st_mtime)
-
-        self.arch = zipfile.ZipFile(self.gtfs, mode="r")
+            self.arch = zipfile.ZipFile(self.gtfs, mode="r")
 
     def load_gtfs(self):
         today = datetime.today()
@@ -78,61 +122,89 @@ class GdanskData:
         today_str = today.strftime("%Y%m%d")
 
         ### ACTIVE DATES ###
-        print("\033[1A\033[K" + "GTFS: Loading active services (calendar_dates.txt)")
+        status("GTFS: Loading active services (calendar_dates.txt)")
 
-        with self.arch.open("calendar_dates.txt", mode="r") as buffer:
-            for row in csv.DictReader(io.TextIOWrapper(buffer, encoding="utf8", newline="")):
-                if row["date"] == today_str: self.services.add(row["service_id"])
+        with open_zip_text(self.arch, "calendar_dates.txt") as buffer:
+            reader = csv.reader(buffer)
+            header = next(reader)
+            service_col, date_col = header.index("service_id"), header.index("date")
+
+            for row in reader:
+                if not row: continue
+                if row[date_col] == today_str: self.services.add(row[service_col])
 
         ### TRIP_ID → ROUTE_ID ###
-        print("\033[1A\033[K" + "GTFS: Loading active trips (trips.txt)")
+        status("GTFS: Loading active trips (trips.txt)")
+
+        with open_zip_text(self.arch, "trips.txt") as buffer:
+            reader = csv.reader(buffer)
+            header = next(reader)
+            trip_col, route_col = header.index("trip_id"), header.index("route_id")
+            service_col = header.index("service_id")
+
+            for row in reader:
+                if not row: continue
 
-        with self.arch.open("trips.txt", mode="r") as buffer:
-            for row in csv.DictReader(io.TextIOWrapper(buffer, encoding="utf8", newline="")):
                 # Only active trips
-                if row["service_id"] not in self.services: continue
+                if row[service_col] not in self.services: continue
 
-                if ":" in row["route_id"]:
-                    row["agency_id"], row["route_id"] = row["route_id"].split(":")
+                route_id = row[route_col]
+                if ":" in route_id:
+                    agency_id, route_id = route_id.split(":")
 
-                self.trips_route[row["trip_id"]] = row["route_id"]
+                self.trips_route[row[trip_col]] = route_id
 
         ### STOP DEPARTURES ###
-        print("\033[1A\033[K" + "GTFS: Loading departures per stop (stop_times.txt)")
+        status("GTFS: Loading departures per stop (stop_times.txt)")
 
-        with self.arch.open("stop_times.txt", mode="r") as buffer:
-            for row in csv.DictReader(io.TextIOWrapper(buffer, encoding="utf8", newline="")):
-                # Only trips which are in self.trips_route are able to havbe RT data
-                if row["trip_id"] not in self.trips_route: continue
+        with open_zip_text(self.arch, "stop_times.txt") as buffer:
+            reader = csv.reader(buffer)
+            header = next(reader)
+            trip_col, stop_col = header.index("trip_id"), header.index("stop_id")
+            time_col = header.index("departure_time")
 
-                stop = row["stop_id"]
-                route = self.trips_route[row["trip_id"]]
-                static_time = readable_time(row["departure_time"])
+            for row in reader:
+                if not row: continue
+                trip_id = row[trip_col]
 
-                if stop not in self.stop_trips:
-                    self.stop_trips[stop] = {}
+                # Only trips which are in self.trips_route are able to havbe RT data
+                route = self.trips_route.get(trip_id)
+                if route is None: continue
 
-                if route not in self.stop_trips[stop]:
-                    self.stop_trips[stop][route] = {}
+                stop = row[stop_col]
+                static_time = readable_time(row[time_col])
+                key = (stop, route, static_time)
 
-                if self.debug and static_time in self.stop_trips[stop][route]:
+                if self.debug and key in self.stop_trips:
                     print("\033[1m" + "Duplicate departure for S {} R {} T {}: trip {} and {}".format(
-                        stop, route, static_time, self.stop_trips[stop][route][static_time], row["trip_id"],
+                        stop, route, static_time, self.stop_trips[key], trip_id,
                     ) + "\033[0m", end="\n\n")
 
-                self.stop_trips[stop][route][static_time] = row["trip_id"]
+                self.stop_trips[key] = trip_id
 
     def new_gtfs_available(self):
         if is_url(self.source):
-            print("\033[1A\033[K" + "Checking if new GTFS is available at " + self.source)
-            gtfs_request = requests.get(self.source)
-            time = email.utils.parsedate_to_datetime(gtfs_request.headers["Last-Modified"])
+            status("Checking if new GTFS is available at " + self.source)
+            # Only the headers are needed - don't download the whole file
+            gtfs_request = self.session.head(self.source, allow_redirects=True)
+            gtfs_request.raise_for_status()
+
+            # Prefer the ETag, as it changes even if the file is replaced within the same second
+            etag = gtfs_request.headers.get("ETag")
+            if etag and self.etag: return etag != self.etag
+
+            last_modified = gtfs_request.headers["Last-Modified"]
+
+            # Same header as the loaded file - no need to parse it
+            if last_modified == self.last_modified: return False
+
+            modified = email.utils.parsedate_to_datetime(last_modified)
 
         else:
-            print("\033[1A\033[K" + "Checking if file at " + self.source + " has changed")
-            time = datetime.fromtimestamp(os.stat(self.source).st_mtime)
+            status("Checking if file at " + self.source + " has changed")
+            modified = datetime.fromtimestamp(os.stat(self.source).st_mtime)
 
-        if time > self.time: return True
+        if modified > self.time: return True
         else: return False
 
         self.arch = zipfile.ZipFile(self.gtfs, mode="r")
@@ -143,28 +215,33 @@ class RTParser:
         self.debug = bool(debug)
 
         self.trip_vehicle = {}
-        self.trip_delays = {}
+        self.trip_delays = defaultdict(list)
+        self.late_trips = set() # trips with an estimate past 20:00 - next estimates are after midnight
         self.vehicles = {}
 
-        print("\033[1A\033[K" + "Attepmpting to load GTFS")
-        self.gtfs = GdanskData(gtfs_source, bool(debug))
+        # Every loop iteration hits the same hosts - keep the connections alive between them
+        self.session = requests.Session()
+
+        status("Attepmpting to load GTFS")
+        self.gtfs = GdanskData(gtfs_source, bool(debug), self.session)
         self.gtfs.get_gtfs()
         self.gtfs.load_gtfs()
 
     def init_container(self):
-        print("\033[1A\033[K" + "RT: Creating a new, empty gtfs-rt FeedMessage()")
+        status("RT: Creating a new, empty gtfs-rt FeedMessage()")
 
         self.container = gtfs_rt.FeedMessage()
         self.container.header.gtfs_realtime_version = "2.0"
         self.container.header.incrementality = 0
         self.container.header.timestamp = round(datetime.today().timestamp())
 
-    def alerts(self):
-        print("\033[1A\033[K" + "RT: Loading and creating FeedEntities for ZTM Gdańsk alerts")
-
-        req = requests.get("http://ztm.gda.pl/rozklady/download/opendata_out/bsk.json", verify=False)
+    def fetch_json(self, url, **kwargs):
+        req = self.session.get(url, **kwargs)
         req.raise_for_status()
-        req = req.json()
+        return req.json()
+
+    def alerts(self, req):
+        status("RT: Creating FeedEntities for ZTM Gdańsk alerts")
 
         for idx, alert in enumerate(req.get("komunikaty", [])):
             entity = self.container.entity.add()
@@ -174,80 +251,67 @@ class RTParser:
             entity.alert.description_text.translation.add().text = no_html(alert["tresc"])
 
             peroid = entity.alert.active_period.add()
-            peroid.start = round(datetime.strptime(alert["data_rozpoczecia"], "%Y-%m-%d %H:%M:%S").timestamp())
-            peroid.end = round(datetime.strptime(alert["data_zakonczenia"], "%Y-%m-%d %H:%M:%S").timestamp())
+            peroid.start = round(datetime.fromisoformat(alert["data_rozpoczecia"]).timestamp())
+            peroid.end = round(datetime.fromisoformat(alert["data_zakonczenia"]).timestamp())
 
-    def load_delays(self):
+    def load_delays(self, req):
         # Load trip delays to memory
-        print("\033[1A\033[K" + "RT: Loading Tristar per-stop delays")
+        status("RT: Loading Tristar per-stop delays")
 
-        req = requests.get("http://ckan2.multimediagdansk.pl/delays")
-        req.raise_for_status()
-        req = req.json()
+        # Updates from later than 2 minutes into the future must be from yesterday
+        now = datetime.today()
+        today = now.date()
+        yesterday = today - timedelta(days=1)
+        cutoff = (now + timedelta(minutes=2)).time()
 
         for stop_id, delay_container in req.items():
             for delay in delay_container["delay"]:
                 route_id = str(delay["routeId"])
-                time = delay["theoreticalTime"]
+                theoretical_time = delay["theoreticalTime"]
 
-                # self.stop_trips[stop][route][static_time] = row["trip_id"]
-                trip_id = self.gtfs.stop_trips.get(stop_id, {})\
-                                              .get(route_id, {})\
-                                              .get(time, None)\
+                trip_id = self.gtfs.stop_trips.get((stop_id, route_id, theoretical_time))
 
                 if not trip_id:
-                    if self.debug: print("\033[1m" + "No matching trip_id for S {}, R {}, T {}".format(stop_id, route_id, time) + "\033[0m")
+                    if self.debug: print("\033[1m" + "No matching trip_id for S {}, R {}, T {}".format(stop_id, route_id, theoretical_time) + "\033[0m")
                     continue
 
                 # Fix timestamp
-                update_time = datetime.strptime(delay["timestamp"], "%H:%M:%S").time()
+                update_time = time_of_day(*map(int, delay["timestamp"].split(":")))
 
-                if update_time > (datetime.today() + timedelta(minutes=2)).time():
-                    update_time = datetime.combine(
-                        date=(datetime.today().date() - timedelta(days=1)),
-                        time=update_time
-                    )
+                if update_time > cutoff:
+                    update_time = datetime.combine(date=yesterday, time=update_time)
 
                 else:
-                    update_time = datetime.combine(
-                        date=datetime.today().date(),
-                        time=update_time
-                    )
+                    update_time = datetime.combine(date=today, time=update_time)
 
                 # Add some values
                 self.trip_vehicle[trip_id] = str(delay["vehicleId"])
 
-                if trip_id not in self.trip_delays:
-                    self.trip_delays[trip_id] = []
-
-                # Fix estimates
-                estimate = delay["estimatedTime"]
-                if any([re.match(r"2\d:\d\d", i["estimated"]) for i in self.trip_delays[trip_id]]):
-                    estimate_h, estimate_m = map(int, estimate.split(":"))
-                    estimate_h += 24
-                    estimate = "{:0>2d}:{:0>2d}".format(estimate_h, estimate_m)
+                # Fix estimates - kept as seconds since midnight, only used for sorting
+                estimate_h, estimate_m = map(int, delay["estimatedTime"].split(":"))
+                estimate = estimate_h * 3600 + estimate_m * 60
 
-                    del estimate_h, estimate_m
+                if trip_id in self.late_trips:
+                    estimate += 86400
 
-                self.trip_delays[trip_id].append({
-                    "stop_id": stop_id,
-                    "timestamp": round(update_time.timestamp()),
-                    "delay": delay["delayInSeconds"],
-                    "estimated": estimate,
-                })
+                elif estimate_h >= 20:
+                    self.late_trips.add(trip_id)
 
-    def load_vehicles(self):
-        print("\033[1A\033[K" + "RT: Loading Tristar vehicle positions")
+                self.trip_delays[trip_id].append(StopDelay(
+                    stop_id=stop_id,
+                    timestamp=round(update_time.timestamp()),
+                    delay=delay["delayInSeconds"],
+                    estimated=estimate,
+                ))
 
-        req = requests.get("http://ckan2.multimediagdansk.pl/gpsPositions")
-        req.raise_for_status()
-        req = req.json()
+    def load_vehicles(self, req):
+        status("RT: Loading Tristar vehicle positions")
 
         for veh in req["Vehicles"]:
             if not veh["Line"] or veh["GPSQuality"] != 3: continue
 
             veh_id = str(veh["VehicleId"])
-            tstamp = datetime.strptime(veh["DataGenerated"], "%Y-%m-%d %H:%M:%S")
+            tstamp = datetime.fromisoformat(veh["DataGenerated"])
 
             self.vehicles[veh_id] = {
                 "code": str(veh["VehicleCode"]),
@@ -258,22 +322,22 @@ class RTParser:
             }
 
     def updates(self):
-        print("\033[1A\033[K" + "RT: Creating FeedEnities for trip delays and vehicle positions")
+        status("RT: Creating FeedEnities for trip delays and vehicle positions")
 
         for idx, (trip_id, stop_updates) in enumerate(self.trip_delays.items()):
             entity = self.container.entity.add()
             entity.id = "UPDATE_{}".format(idx)
 
-            stop_updates = sorted(stop_updates, key=lambda i: i["estimated"])
+            stop_updates = sorted(stop_updates, key=attrgetter("estimated"))
 
             entity.trip_update.trip.trip_id = trip_id
-            entity.trip_update.timestamp = min([i["timestamp"] for i in stop_updates])
-            entity.trip_update.delay = stop_updates[0]["delay"]
+            entity.trip_update.timestamp = min(i.timestamp for i in stop_updates)
+            entity.trip_update.delay = stop_updates[0].delay
 
             for stop_update in stop_updates:
                 update_event = entity.trip_update.stop_time_update.add()
-                update_event.stop_id = stop_update["stop_id"]
-                update_event.arrival.delay = stop_update["delay"]
+                update_event.stop_id = stop_update.stop_id
+                update_event.arrival.delay = stop_update.delay
 
             if self.trip_vehicle[trip_id] in self.vehicles:
                 veh_data = self.vehicles[self.trip_vehicle[trip_id]]
@@ -293,7 +357,7 @@ class RTParser:
                 veh_entity.vehicle.timestamp = veh_data["timestamp"]
 
     def dump_container(self, target="gtfs-rt.pb", for_humans=False):
-        print("\033[1A\033[K" + "RT: Dumping FeedMessage to {} ({})".format(
+        status("RT: Dumping FeedMessage to {} ({})".format(
             target, "human-readable" if for_humans else "binary"
         ))
 
@@ -307,9 +371,18 @@ class RTParser:
 
     def create(self, target, for_humans):
         self.init_container()
-        self.alerts()
-        self.load_delays()
-        self.load_vehicles()
+
+        # All 3 endpoints are independent - download them at the same time
+        status("RT: Downloading alerts, delays and vehicle positions")
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            alerts = executor.submit(self.fetch_json, "http://ztm.gda.pl/rozklady/download/opendata_out/bsk.json", verify=False)
+            delays = executor.submit(self.fetch_json, "http://ckan2.multimediagdansk.pl/delays")
+            vehicles = executor.submit(self.fetch_json, "http://ckan2.multimediagdansk.pl/gpsPositions")
+
+            self.alerts(alerts.result())
+            self.load_delays(delays.result())
+            self.load_vehicles(vehicles.result())
+
         self.updates()
         self.dump_container(target, for_humans)
 
@@ -325,20 +398,20 @@ class RTParser:
                 rt_update = datetime.today()
 
                 if (datetime.today() - gtfs_update).total_seconds() > gtfs_check_peroid:
-                    print("\033[1A\033[K" + "Checking if new GTFS is available")
+                    status("Checking if new GTFS is available")
                     if self.gtfs.new_gtfs_available():
-                        print("\033[1A\033[K" + "Attepmpting to load GTFS")
+                        status("Attepmpting to load GTFS")
                         self.gtfs.get_gtfs()
                         self.gtfs.load_gtfs()
 
-                print("\033[1A\033[K" + "Creating GTFS-Realtime")
+                status("Creating GTFS-Realtime")
                 self.create(target, for_humans)
 
                 # Sleep by `peroid` seconds minus what it took to create GTFS-RT file
                 sleep_time = peroid - (datetime.today() - rt_update).total_seconds()
                 if sleep_time < 0: sleep_time = 15
 
-                print("\033[1A\033[K" + "Sleeping until " +
+                status("Sleeping until " +
                     (datetime.today() + timedelta(seconds=sleep_time)).strftime("%H:%M:%S"),
                     end="\n\n"
                 )